@@ -1,11 +1,19 @@
 import streamlit as st
-import trafilatura
-from pypdf import PdfReader
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.csv as pv
+import bisect
+import html
+import io
+import os
+import shutil
+import tempfile
+import textwrap
+import threading
 import zipfile
-import time
+import zlib
 import plotly.graph_objects as go
-from transformers import pipeline
 
 # --- CONFIGURATION ---
 st.set_page_config(page_title="Media Shield: Research Scanner", page_icon="🕵️", layout="wide")
@@ -13,11 +21,129 @@ st.set_page_config(page_title="Media Shield: Research Scanner", page_icon="🕵
 # ==========================================
 # 🧠 THE NEURAL ENGINE (BERT)
 # ==========================================
+# Any Hugging Face checkpoint with Toxic-BERT's six Jigsaw labels works here,
+# e.g. a smaller distilled student for faster CPU scans
+MODEL_NAME = os.environ.get("MEDIA_SHIELD_MODEL", "unitary/toxic-bert")
+
+# Token budget per record (~512 chars of English text)
+MAX_TOKENS = 128
+
+# Where the exported ONNX graph is kept between app restarts
+ONNX_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "media-shield", MODEL_NAME.replace("/", "--") + "-onnx")
+
+def load_onnx_model():
+    """Loads MODEL_NAME into ONNX Runtime, exporting it on first use (needs optimum[onnxruntime])"""
+    from optimum.onnxruntime import ORTModelForSequenceClassification
+
+    if not os.path.isfile(os.path.join(ONNX_CACHE_DIR, "model.onnx")):
+        # Export into a scratch dir and move it into place, so an interrupted
+        # export never leaves a half-written cache behind
+        os.makedirs(os.path.dirname(ONNX_CACHE_DIR), exist_ok=True)
+        scratch = tempfile.mkdtemp(dir=os.path.dirname(ONNX_CACHE_DIR))
+        try:
+            ORTModelForSequenceClassification.from_pretrained(MODEL_NAME, export=True).save_pretrained(scratch)
+            shutil.rmtree(ONNX_CACHE_DIR, ignore_errors=True)
+            os.replace(scratch, ONNX_CACHE_DIR)
+        finally:
+            shutil.rmtree(scratch, ignore_errors=True)
+    return ORTModelForSequenceClassification.from_pretrained(ONNX_CACHE_DIR)
+
+def cpu_has_bf16():
+    """True when oneDNN can run bfloat16 natively (AVX512-BF16 / AMX)"""
+    import torch
+
+    try:
+        return torch.ops.mkldnn._is_mkldnn_bf16_supported()
+    except (AttributeError, RuntimeError):
+        return False
+
+def check_labels(classifier):
+    """Fails fast when the configured checkpoint doesn't output Toxic-BERT's six labels"""
+    labels = set(classifier.model.config.id2label.values())
+    if labels != set(LABELS):
+        raise ValueError(
+            f"MEDIA_SHIELD_MODEL={MODEL_NAME!r} outputs labels {sorted(labels)}, "
+            f"but the scanner needs exactly {sorted(LABELS)}."
+        )
+    return classifier
+
 @st.cache_resource
 def load_brain():
+    # Heavy imports live here so the torch/transformers import cost is only
+    # paid once, when the model is first loaded, and never blocks page render.
+    import torch
+    from transformers import pipeline
+
     # Load Toxic-BERT. 
     # top_k=None ensures we get scores for ALL categories (toxic, threat, etc.)
-    return pipeline("text-classification", model="unitary/toxic-bert", top_k=None)
+    options = dict(top_k=None, truncation=True, max_length=MAX_TOKENS)
+    device = 0 if torch.cuda.is_available() else -1
+
+    if device < 0:
+        # One intra-op thread per physical core (~half the logical count) and no
+        # inter-op pool is the fastest setup for one BERT batch at a time
+        torch.set_num_threads(max(1, (os.cpu_count() or 2) // 2))
+        try:
+            torch.set_num_interop_threads(1)
+        except RuntimeError:
+            pass # Can only be set before torch starts its first parallel work
+
+        # On CPU, prefer ONNX Runtime's fused graph when optimum is installed
+        try:
+            onnx_classifier = pipeline("text-classification", model=load_onnx_model(), tokenizer=MODEL_NAME, **options)
+        except Exception:
+            pass # Not installed, offline, or the export failed: fall back to PyTorch below
+        else:
+            return check_labels(onnx_classifier)
+
+    if device >= 0:
+        # Half-precision weights halve memory traffic on the GPU
+        options["torch_dtype"] = torch.float16
+
+    classifier = check_labels(pipeline("text-classification", model=MODEL_NAME, device=device, **options))
+
+    if device < 0:
+        # BF16 CPUs keep fp32 weights and autocast in classify_batch
+        if not cpu_has_bf16():
+            # Older CPUs: swap the encoder's Linear layers for INT8 (FBGEMM) kernels
+            classifier.model = torch.quantization.quantize_dynamic(classifier.model, {torch.nn.Linear}, dtype=torch.qint8)
+    elif hasattr(torch, "compile"):
+        # On GPU, cut per-call dispatch overhead with CUDA graphs.
+        # Compiled after the pipeline is built (passing a compiled model to pipeline() can no-op).
+        classifier.model = torch.compile(classifier.model, mode="reduce-overhead", dynamic=True)
+    return classifier
+
+@st.cache_resource
+def warm_up_brain():
+    """Starts loading the model in the background, once per process,
+    so it is usually resident before the first scan is requested"""
+    thread = threading.Thread(target=load_brain, daemon=True)
+    thread.start()
+    return thread
+
+# Records sent to the model per pipeline call
+BATCH_SIZE = 16
+
+# Toxic-BERT's output labels and their weight in the Composite Danger Score
+LABELS = ('toxic', 'severe_toxic', 'obscene', 'threat', 'insult', 'identity_hate')
+LABEL_IDX = {label: i for i, label in enumerate(LABELS)}
+DANGER_WEIGHTS = np.array([30, 60, 0, 80, 0, 100], dtype=np.float64)
+
+# Started only once LABELS exists: the loader thread validates against it
+warm_up_brain()
+
+@st.cache_data(max_entries=256, show_spinner=False) # The scan has its own progress bar
+def classify_batch(_classifier, texts):
+    """Runs the classifier over a tuple of texts. Cached on the texts alone,
+    so re-scanning the same rows skips the model."""
+    import torch
+
+    # No autograd bookkeeping: this is pure inference.
+    # On BF16 CPUs, autocast runs the Linear/matmul ops in bfloat16 while the
+    # weights stay fp32 and autocast's fp32-listed ops keep full precision.
+    use_bf16 = _classifier.device.type == "cpu" and cpu_has_bf16()
+    with torch.inference_mode(), torch.autocast("cpu", dtype=torch.bfloat16, enabled=use_bf16):
+        return _classifier(list(texts), batch_size=BATCH_SIZE)
 
 class NeuralScanner:
     def __init__(self):
@@ -25,68 +151,147 @@ class NeuralScanner:
 
     def analyze_batch(self, texts, progress_bar):
         """
-        Analyzes a list of texts one by one and returns a list of results.
-        Updates the progress bar as it goes.
+        Analyzes a list of texts in batches of BATCH_SIZE and returns a DataFrame of results.
+        Updates the progress bar after each batch.
         """
-        results = []
         total = len(texts)
         
-        for i, text in enumerate(texts):
+        # One row of label scores per text, filled in by row index
+        scores = np.zeros((total, len(LABELS)), dtype=np.float64)
+        scanned = np.zeros(total, dtype=bool) # Stays False for rows that failed to scan
+        
+        for start in range(0, total, BATCH_SIZE):
+            chunk = texts[start:start + BATCH_SIZE]
             try:
-                # Analyze text (truncated to 512 chars for speed)
-                prediction = self.classifier(text[:512])
-                
-                # Parse output
-                # Output format: [[{'label': 'toxic', 'score': 0.9}, ...]]
-                data = prediction[0] if isinstance(prediction, list) else prediction
-                scores = {item['label']: item['score'] for item in data}
-                
-                # Calculate Composite Danger Score
-                danger = (
-                    scores.get('identity_hate', 0) * 100 + 
-                    scores.get('threat', 0) * 80 + 
-                    scores.get('severe_toxic', 0) * 60 +
-                    scores.get('toxic', 0) * 30
-                )
-                
-                results.append({
-                    "text": text,
-                    "danger_score": min(int(danger), 100),
-                    "identity_hate": scores.get('identity_hate', 0),
-                    "threat": scores.get('threat', 0),
-                    "toxic": scores.get('toxic', 0)
-                })
-                
-                # Update UI every step
-                progress_bar.progress((i + 1) / total, text=f"Scanning record {i+1}/{total}...")
-                
-            except Exception as e:
-                # If one fails, skip it, don't crash
-                continue
+                # Analyze the whole batch in one call (each text truncated to 512 chars for speed)
+                predictions = classify_batch(self.classifier, tuple(text[:512] for text in chunk))
+                indices = range(start, start + len(chunk))
+            except Exception:
+                # If a batch fails, retry its records one at a time so only
+                # the bad ones are skipped, don't crash (the report flags skipped rows)
+                predictions, indices = [], []
+                for i, text in enumerate(chunk, start):
+                    try:
+                        predictions.extend(classify_batch(self.classifier, (text[:512],)))
+                    except Exception:
+                        continue
+                    indices.append(i)
+            
+            # Parse output
+            # Output format: [[{'label': 'toxic', 'score': 0.9}, ...], ...] (one list per text)
+            for i, data in zip(indices, predictions):
+                row = scores[i]
+                for item in data:
+                    row[LABEL_IDX[item['label']]] = item['score']
+                scanned[i] = True
+            
+            # Update UI once per batch
+            done = start + len(chunk)
+            progress_bar.progress(done / total, text=f"Scanning record {done}/{total}...")
                 
-        return pd.DataFrame(results)
+        # Calculate Composite Danger Score for the whole batch in one matmul
+        # (float64, like the old per-row float math, so scores on the 30/70/80
+        # thresholds don't round across them)
+        danger_score = np.minimum(scores @ DANGER_WEIGHTS, 100).astype(np.int32)
+        
+        results = pd.DataFrame({
+            "text": texts,
+            "danger_score": danger_score,
+            "identity_hate": scores[:, LABEL_IDX['identity_hate']],
+            "threat": scores[:, LABEL_IDX['threat']],
+            "toxic": scores[:, LABEL_IDX['toxic']]
+        })
+        return results[scanned].reset_index(drop=True)
+
+@st.cache_resource
+def get_scanner():
+    return NeuralScanner()
 
 # ==========================================
 # 🛠️ DATA EXTRACTION
 # ==========================================
-def load_dataframe(file):
-    """Smart loader that handles CSV or Zipped CSV"""
-    try:
-        if file.name.endswith('.csv'):
-            return pd.read_csv(file)
-        elif file.name.endswith('.zip'):
-            with zipfile.ZipFile(file) as z:
-                target = next((f for f in z.namelist() if f.endswith('.csv')), None)
-                with z.open(target) as f:
-                    return pd.read_csv(f)
-    except: return None
-
-def find_text_column(df):
+# Rows kept from an upload (the scan itself only reads the first 200)
+MAX_ROWS = 50000
+
+# Quoted comments often span several lines (e.g. Jigsaw's comment_text)
+CSV_PARSE_OPTIONS = pv.ParseOptions(newlines_in_values=True)
+
+def read_column_names(f):
+    """Reads the header with Arrow itself, so the names match what read_text_column selects"""
+    return pv.open_csv(f, parse_options=CSV_PARSE_OPTIONS).schema.names
+
+def read_text_column(f, text_col):
+    """Streams a single column through Arrow's CSV reader, stopping after MAX_ROWS rows"""
+    reader = pv.open_csv(f, parse_options=CSV_PARSE_OPTIONS, convert_options=pv.ConvertOptions(
+        include_columns=[text_col], column_types={text_col: pa.string()}
+    ))
+    batches, rows = [], 0
+    for batch in reader:
+        batches.append(batch)
+        rows += batch.num_rows
+        if rows >= MAX_ROWS: break
+    return pa.Table.from_batches(batches, schema=reader.schema).to_pandas().head(MAX_ROWS)
+
+# Everything a malformed upload can raise: parse/encoding errors (ValueError),
+# Arrow errors, broken archives, corrupt or truncated compressed data
+# (zlib.error, EOFError, OSError), encrypted members (RuntimeError) and
+# unsupported compression (NotImplementedError)
+UPLOAD_ERRORS = (
+    ValueError, RuntimeError, NotImplementedError, EOFError, OSError,
+    zipfile.BadZipFile, zlib.error, pa.ArrowException
+)
+
+@st.cache_data(ttl=3600, max_entries=64)
+def load_dataframe(name, data):
+    """Smart loader that handles CSV or Zipped CSV.
+    Peeks at the header first, then reads only the text column.
+    Cached on the upload's bytes, so reruns don't re-parse the same file.
+    Raises one of UPLOAD_ERRORS when the file can't be read."""
+    file = io.BytesIO(data)
+    if name.endswith('.csv'):
+        text_col = find_text_column(read_column_names(file))
+        file.seek(0)
+        return read_text_column(file, text_col)
+    elif name.endswith('.zip'):
+        with zipfile.ZipFile(file) as z:
+            target = next((f for f in z.namelist() if f.endswith('.csv')), None)
+            if target is None:
+                raise ValueError("the ZIP archive contains no .csv file")
+            with z.open(target) as f:
+                text_col = find_text_column(read_column_names(f))
+            with z.open(target) as f:
+                return read_text_column(f, text_col)
+    raise ValueError(f"unsupported file type: {name}")
+
+def find_text_column(columns):
     """Auto-detects the column containing the comments"""
     candidates = ['comment_text', 'text', 'content', 'tweet', 'message', 'review']
     for col in candidates:
-        if col in df.columns: return col
-    return df.columns[0] # Fallback
+        if col in columns: return col
+    return columns[0] # Fallback
+
+# ==========================================
+# 📊 CHARTS
+# ==========================================
+# Score bands for the pie: < 30 Safe, 30-69 Suspicious, >= 70 Dangerous
+RISK_BANDS = [30, 70]
+
+# Worst-offender card borders: orange up to 80, red above
+BORDER_STEPS = [80]
+BORDER_COLORS = ['#FFA500', '#FF0000']
+
+@st.cache_resource(max_entries=64)
+def build_risk_pie(safe, sus, danger):
+    """Builds the Safe/Suspicious/Dangerous donut, cached per distinct breakdown.
+    st.plotly_chart only serializes the figure, so sharing one object is safe."""
+    fig = go.Figure(data=[go.Pie(
+        labels=['Safe', 'Suspicious', 'Dangerous'],
+        values=[safe, sus, danger],
+        hole=.4,
+        marker_colors=['#4CAF50', '#FFA500', '#FF0000']
+    )])
+    fig.update_layout(height=300, margin=dict(t=0, b=0, l=0, r=0))
+    return fig
 
 # ==========================================
 # 🖥️ UI LAYOUT
@@ -113,18 +318,19 @@ with col1:
     text_col = None
     
     if uploaded:
-        df = load_dataframe(uploaded)
-        if df is not None:
+        try:
+            df = load_dataframe(uploaded.name, uploaded.getvalue())
+        except UPLOAD_ERRORS as e:
+            st.error(f"Could not read file: {e}")
+        else:
             dataset = df
-            text_col = find_text_column(df)
+            text_col = df.columns[0] # The loader keeps only the detected text column
             st.success(f"Loaded {len(df)} rows.")
             st.info(f"Targeting Column: **'{text_col}'**")
             
             # Preview
             with st.expander("Preview Data"):
                 st.dataframe(df.head(3))
-        else:
-            st.error("Could not read file.")
 
     start_btn = st.button("🚀 Start Deep Scan", type="primary", use_container_width=True, disabled=(dataset is None))
 
@@ -133,7 +339,7 @@ with col2:
     st.subheader("2. Audit Report")
     
     if start_btn and dataset is not None:
-        scanner = NeuralScanner()
+        scanner = get_scanner()
         
         # 1. Prepare the Batch
         # We take the top N rows based on the slider
@@ -144,6 +350,10 @@ with col2:
         results_df = scanner.analyze_batch(batch_data, progress)
         progress.empty() # Remove bar when done
         
+        skipped = len(batch_data) - len(results_df)
+        if skipped:
+            st.warning(f"{skipped} of {len(batch_data)} records could not be scanned and were skipped.")
+        
         if not results_df.empty:
             # 3. CALCULATE STATS
             avg_danger = int(results_df['danger_score'].mean())
@@ -161,18 +371,13 @@ with col2:
                 
             # --- PIE CHART ---
             # Categorize the results
-            safe = len(results_df[results_df['danger_score'] < 30])
-            sus = len(results_df[(results_df['danger_score'] >= 30) & (results_df['danger_score'] < 70)])
-            danger = len(results_df[results_df['danger_score'] >= 70])
+            bands = np.searchsorted(RISK_BANDS, results_df['danger_score'], side='right')
+            safe, sus, danger = (int(n) for n in np.bincount(bands, minlength=3))
             
-            fig = go.Figure(data=[go.Pie(
-                labels=['Safe', 'Suspicious', 'Dangerous'],
-                values=[safe, sus, danger],
-                hole=.4,
-                marker_colors=['#4CAF50', '#FFA500', '#FF0000']
-            )])
-            fig.update_layout(height=300, margin=dict(t=0, b=0, l=0, r=0))
-            st.plotly_chart(fig, use_container_width=True)
+            st.plotly_chart(
+                build_risk_pie(safe, sus, danger), use_container_width=True,
+                theme=None, config={"staticPlot": True, "displayModeBar": False}
+            )
             
             # --- THE "WORST OFFENDERS" TABLE ---
             st.subheader("🚩 The Worst Offenders")
@@ -181,19 +386,28 @@ with col2:
             # Sort by danger score descending
             worst_df = results_df.sort_values(by="danger_score", ascending=False).head(5)
             
+            cards = []
             for index, row in worst_df.iterrows():
                 # Dynamic Border Color
-                b_color = "#FF0000" if row['danger_score'] > 80 else "#FFA500"
+                b_color = BORDER_COLORS[bisect.bisect_left(BORDER_STEPS, row['danger_score'])]
+                
+                # Flatten newlines and escape markup so one row can't break the cards after it
+                snippet = html.escape(" ".join(row['text'][:200].split()))
                 
-                st.markdown(f"""
+                # Dedent each card on its own: the cards share one markdown string,
+                # and indented lines there would render as code blocks
+                cards.append(textwrap.dedent(f"""
                 <div style="border-left: 5px solid {b_color}; background-color: #262730; padding: 10px; margin-bottom: 10px; border-radius: 5px;">
                     <div style="display: flex; justify-content: space-between;">
                         <span style="font-weight: bold; color: {b_color};">THREAT SCORE: {row['danger_score']}</span>
                         <span style="color: #aaa; font-size: 0.8em;">Identity Hate Confidence: {int(row['identity_hate']*100)}%</span>
                     </div>
-                    <p style="margin-top: 5px; font-style: italic;">"{row['text'][:200]}..."</p>
+                    <p style="margin-top: 5px; font-style: italic;">"{snippet}..."</p>
                 </div>
-                """, unsafe_allow_html=True)
+                """))
+            
+            # Render all cards in one Streamlit message instead of one per row
+            st.markdown("".join(cards), unsafe_allow_html=True)
                 
             # Download Full Report
             csv_data = results_df.to_csv(index=False).encode('utf-8')